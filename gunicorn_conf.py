@@ -0,0 +1,13 @@
+# Run with: gunicorn -c gunicorn_conf.py web:app
+workers = 2
+threads = 8
+worker_class = "gthread"
+# The dogpile memory cache lives in each worker process either way.
+preload_app = False
+
+
+def post_worker_init(worker):
+    # Each worker warms its own cache.
+    import web
+
+    web.start_prefetch()
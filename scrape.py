@@ -1,17 +1,85 @@
 import datetime
-from collections import defaultdict
-from functools import lru_cache
+import logging
+import os
+import sys
+import threading
+import types
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import cached_property
 
 import requests
 from dogpile.cache import make_region
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+log = logging.getLogger(__name__)
 
 # In-case we accidentally hammer the upstream API.
 GLOBAL_HEADERS = {"User-Agent": "github.com/joshp123/nl_transport_stuff"}
 API_URL = "http://v0.ovapi.nl/"
+CACHE_TTL = int(os.environ.get("OVAPI_CACHE_TTL", 30))
+# (connect, read) seconds, so a stalled read fails and gets retried.
+REQUEST_TIMEOUT = (3.05, 10)
+
+
+_MISSING = object()
+
+
+class LRUDict(OrderedDict):
+    """Dict that evicts the least recently used key past maxsize.
+
+    Only ``get``, ``__setitem__`` and ``pop`` are locked, as those are all
+    dogpile's memory backend calls; other dict methods are not thread-safe.
+    """
+
+    def __init__(self, maxsize=256):
+        super().__init__()
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self:
+                return default
+            self.move_to_end(key)
+            return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+            if len(self) > self.maxsize:
+                self.popitem(last=False)
+
+    def pop(self, key, default=_MISSING):
+        with self._lock:
+            if default is _MISSING:
+                return super().pop(key)
+            return super().pop(key, default)
+
+
+def _bg_refresh(cache, somekey, creator, mutex):
+    # Serve the stale value while a single thread fetches a fresh one.
+    def runner():
+        try:
+            cache.set(somekey, creator())
+        finally:
+            mutex.release()
 
-cache_region = make_region().configure(
-    "dogpile.cache.memory", expiration_time=60
+    threading.Thread(target=runner, daemon=True).start()
+
+
+cache_region = make_region(async_creation_runner=_bg_refresh).configure(
+    "dogpile.cache.memory",
+    arguments={"cache_dict": LRUDict(maxsize=256)},
+    expiration_time=CACHE_TTL,
 )
 
 direction_to_destination = {
@@ -33,23 +101,52 @@ direction_to_destination = {
     "Westbound": ["Parkweg", "Schiedam Centrum"],
 }
 
-destination_to_direction = {}
-for k, v in direction_to_destination.items():
-    for i in v:
-        destination_to_direction[i] = k
+_destination_to_direction = {}
+for direction, destinations in direction_to_destination.items():
+    for destination in destinations:
+        # A duplicate would silently map the destination to the last one.
+        if destination in _destination_to_direction:
+            raise ValueError(
+                f"{destination} is listed under both "
+                f"{_destination_to_direction[destination]} and {direction}"
+            )
+        _destination_to_direction[destination] = direction
+DESTINATION_TO_DIRECTION = types.MappingProxyType(_destination_to_direction)
 
 
 class OVAPI:
+    def __init__(self):
+        # Reuse one keep-alive connection pool for every call to the API,
+        # sized for the gunicorn worker threads in gunicorn_conf.py.
+        self.session = requests.Session()
+        self.session.headers.update(GLOBAL_HEADERS)
+        retries = Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+        )
+        self.session.mount(
+            "http://",
+            HTTPAdapter(
+                pool_connections=4, pool_maxsize=16, max_retries=retries
+            ),
+        )
+
     @cache_region.cache_on_arguments()
     def get(self, endpoint):
-        print("making call to {}".format(endpoint))
+        log.debug("making call to %s", endpoint)
         target = "{}{}".format(API_URL, endpoint)
-        resp = requests.get(target, headers=GLOBAL_HEADERS)
-        resp.raise_for_status
+        resp = self.session.get(target, timeout=REQUEST_TIMEOUT)
+        resp.raise_for_status()
+        if orjson is not None:
+            return orjson.loads(resp.content)
         return resp.json()
 
 
 global_api_client = OVAPI()
+# Shared by every Station so prefetching doesn't spin up threads per call.
+prefetch_executor = ThreadPoolExecutor(max_workers=8)
 
 
 class Station:
@@ -57,17 +154,33 @@ class Station:
 
     def __init__(self, stop_name):
         self.stop_name = stop_name
+        self._cached = None
 
     def __repr__(self):
         # Kinda hacky, what if there are no timing points? w/e
         return self.directions[0].stop_name
 
     def _get(self):
-        url = self.endpoint.format(self.stop_name)
-        return global_api_client.get(url)[self.stop_name]
+        if self._cached is None:
+            url = self.endpoint.format(self.stop_name)
+            self._cached = global_api_client.get(url)[self.stop_name]
+        return self._cached
+
+    def prefetch_directions(self):
+        # Warm the cache for every timing point concurrently, so the lazy
+        # per-direction lookups below are cache hits rather than serial calls.
+        endpoints = [
+            DirectionAtStation._endpoint.format(timing_point)
+            for timing_point in self._get().keys()
+        ]
+        futures = [
+            prefetch_executor.submit(global_api_client.get, endpoint)
+            for endpoint in endpoints
+        ]
+        for future in as_completed(futures):
+            future.result()
 
-    @property
-    # @lru_cache(maxsize=1)
+    @cached_property
     def directions(self):
         return [
             DirectionAtStation(self, timing_point)
@@ -87,8 +200,13 @@ class Station:
         return lines
 
     def summary(self):
-        for line in self._all_lines:
-            print(line.summary)
+        self.prefetch_directions()
+        out = [
+            line.human_summary
+            for direction in self.directions
+            for line in direction.lines
+        ]
+        sys.stdout.write("\n".join(out) + "\n")
 
     @property
     def departures(self):
@@ -102,35 +220,45 @@ class DirectionAtStation:
     def __init__(self, station, timing_point_code):
         self.timing_point_code = timing_point_code
         self.station = station
+        self._cached = None
 
     @property
     def endpoint(self):
         return self._endpoint.format(self.timing_point_code)
 
-    @property
-    @lru_cache(maxsize=1)
+    @cached_property
     def stop_name(self):
         return self._get()["Stop"]["TimingPointName"]
 
     def _get(self):
-        return global_api_client.get(self.endpoint)[self.timing_point_code]
+        if self._cached is None:
+            self._cached = global_api_client.get(self.endpoint)[
+                self.timing_point_code
+            ]
+        return self._cached
 
-    @property
-    @lru_cache(maxsize=1)
+    @cached_property
     def lines(self):
-        line_names = set([t.line for t in self.trains])
-        return [LineWithDirection(name, self) for name in line_names]
+        return [LineWithDirection(name, self) for name in self.trains_by_line]
 
-    @property
+    @cached_property
     def trains(self):
         return sorted(
             [Train(k, v) for k, v in self._get()["Passes"].items()],
             key=lambda t: t.arrival_time,
         )
 
+    @cached_property
+    def trains_by_line(self):
+        trains_by_line = defaultdict(list)
+        for train in self.trains:
+            trains_by_line[train.line].append(train)
+        return dict(trains_by_line)
+
     @property
     def next_arrivals(self):
-        return sorted(self.trains, key=lambda t: t.arrival_time)
+        # trains is already sorted by arrival time.
+        return self.trains
 
     @property
     def destinations_by_line(self):
@@ -151,7 +279,7 @@ class LineWithDirection:
 
     @property
     def direction(self):
-        return destination_to_direction[list(self.destinations)[0]]
+        return DESTINATION_TO_DIRECTION[self.trains[0].destination]
 
     @property
     def summary(self):
@@ -174,60 +302,67 @@ class LineWithDirection:
 
     @property
     def next_three_departure_times(self):
-        retval = []
-        for x in range(0, 3):
-            try:
-                retval.append(self.trains[x].minutes_until_departure)
-            except IndexError:
-                # No more departures, should log this I guess
-                pass
-        return retval
+        return [t.minutes_until_departure for t in self.trains[:3]]
 
     @property
     def trains(self):
-        return [
-            t for t in self.timing_point.trains if t.line == self.line_name
-        ]
+        return self.timing_point.trains_by_line[self.line_name]
 
-    @property
+    @cached_property
     def destinations(self):
-        return set([t.destination for t in self.trains])
+        return {t.destination for t in self.trains}
 
     @property
     def intervals(self):
-        intervals = []
+        minimum = maximum = None
         trains_to_use = sorted(
             self.trains, key=lambda t: t.target_arrival_time
         )
-        for idx, train in enumerate(trains_to_use):
-            try:
-                interval = (
-                    trains_to_use[idx + 1].target_arrival_time
-                    - train.target_arrival_time
-                )
-                intervals.append(timedelta_to_integer_minutes(interval))
-            except IndexError:
-                break
-        return Intervals(intervals)
+        # Track the extrema as we go rather than building a list of gaps.
+        for train, next_train in zip(trains_to_use, trains_to_use[1:]):
+            interval = timedelta_to_integer_minutes(
+                next_train.target_arrival_time - train.target_arrival_time
+            )
+            if minimum is None:
+                minimum = maximum = interval
+            elif interval < minimum:
+                minimum = interval
+            elif interval > maximum:
+                maximum = interval
+        if minimum is None:
+            raise ValueError("need at least two trains to compute intervals")
+        return Intervals(minimum, maximum)
 
 
 class Intervals:
-    def __init__(self, intervals):
-        self.intervals = intervals
-        self.minimum = min(intervals)
-        self.maximum = max(intervals)
+    def __init__(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        if minimum != maximum:
+            self._repr = f"{minimum}-{maximum}"
+        else:
+            self._repr = f"{minimum}"
 
     def __repr__(self):
-        if self.minimum != self.maximum:
-            return f"{self.minimum}-{self.maximum}"
-        else:
-            return f"{self.minimum}"
+        return self._repr
 
 
 class Train:
     def __init__(self, train_name, train_data):
         self.train_name = train_name
         self.train_data = train_data
+        # Parse everything up front; these are read many times per render.
+        self.line = train_data["LinePublicNumber"]
+        self.destination = train_data["DestinationName50"]
+        self.arrival_time = datetime.datetime.fromisoformat(
+            train_data["ExpectedArrivalTime"]
+        )
+        self.target_arrival_time = datetime.datetime.fromisoformat(
+            train_data["TargetArrivalTime"]
+        )
+        self.delay = self.arrival_time - self.target_arrival_time
+        self.delay_seconds = self.delay.total_seconds()
+        self.delay_mins = self.delay_seconds / 60
 
     def __repr__(self):
         return (
@@ -236,26 +371,6 @@ class Train:
             f"{self.delay_mins})"
         )
 
-    @property
-    def line(self):
-        return self.train_data["LinePublicNumber"]
-
-    @property
-    def destination(self):
-        return self.train_data["DestinationName50"]
-
-    @property
-    def arrival_time(self):
-        return datetime.datetime.fromisoformat(
-            self.train_data["ExpectedArrivalTime"]
-        )
-
-    @property
-    def target_arrival_time(self):
-        return datetime.datetime.fromisoformat(
-            self.train_data["TargetArrivalTime"]
-        )
-
     @property
     def time_until_departure(self):
         now = datetime.datetime.now()
@@ -265,26 +380,25 @@ class Train:
     def minutes_until_departure(self):
         return timedelta_to_integer_minutes(self.time_until_departure)
 
-    @property
-    def delay(self):
-        return self.arrival_time - self.target_arrival_time
-
-    @property
-    def delay_mins(self):
-        return self.delay.total_seconds() / 60
-
 
 def timedelta_to_integer_minutes(timedelta):
-    return int(timedelta.total_seconds() / 60)
+    # Integer arithmetic only, truncating toward zero like int() did, so a
+    # train that left seconds ago still shows 0 rather than -1.
+    if timedelta.days < 0:
+        timedelta = -timedelta
+        return -(timedelta.days * 1440 + timedelta.seconds // 60)
+    return timedelta.days * 1440 + timedelta.seconds // 60
 
 
 def get_morning_commute():
     station = Station("Bdp")
+    station.prefetch_directions()
     return station.lines["E"]["Southbound"].summary
 
 
 def get_evening_commute():
     station = Station("Whp")
+    station.prefetch_directions()
     return station.lines["E"]["Northbound"].summary
 
 
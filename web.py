@@ -1,9 +1,31 @@
-from flask import Flask, escape, request
+import logging
+import threading
+import time
+
+from flask import Flask, escape, jsonify, request
 import scrape
 
+log = logging.getLogger(__name__)
+
 app = Flask(__name__)
 
 
+def _prefetch_loop():
+    # Keep the commute endpoints warm so requests are always cache hits.
+    while True:
+        try:
+            scrape.get_morning_commute()
+            scrape.get_evening_commute()
+        except Exception:
+            log.exception("prefetch failed")
+        time.sleep(scrape.CACHE_TTL / 2)
+
+
+def start_prefetch():
+    # Called by the server entry point, so a bare import doesn't poll upstream.
+    threading.Thread(target=_prefetch_loop, daemon=True).start()
+
+
 @app.route("/")
 def hello():
     name = request.args.get("name", "World")
@@ -12,9 +34,15 @@ def hello():
 
 @app.route("/morning")
 def morning():
-    return scrape.get_morning_commute()
+    # Only the upstream data is cached; next3 is counted from now each time.
+    return jsonify(scrape.get_morning_commute())
 
 
 @app.route("/evening")
 def evening():
-    return scrape.get_evening_commute()
+    return jsonify(scrape.get_evening_commute())
+
+
+if __name__ == "__main__":
+    start_prefetch()
+    app.run()